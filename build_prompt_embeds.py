@@ -0,0 +1,55 @@
+import argparse
+
+import torch
+from tqdm import tqdm
+from transformers import AutoTokenizer, CLIPTextModel, BertModel, T5EncoderModel
+
+from dmd.model import encode_prompt
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--caption_path", default="data/diffusion_db_prompts.txt", type=str)
+    parser.add_argument("--model_id", default="runwayml/stable-diffusion-v1-5", type=str)
+    parser.add_argument("--text_encoder_class", default="clip", choices=["clip", "bert", "t5"])
+    parser.add_argument("--save_path", default="data/diffusion_db_prompt_embeds.pt", type=str)
+    parser.add_argument("--batch_size", default=64, type=int)
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    args = parse_args()
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    tokenizer = AutoTokenizer.from_pretrained(args.model_id, subfolder="tokenizer", legacy=False, use_fast=False)
+    if args.text_encoder_class == "clip":
+        text_encoder = CLIPTextModel.from_pretrained(args.model_id, subfolder="text_encoder")
+    elif args.text_encoder_class == "bert":
+        text_encoder = BertModel.from_pretrained(args.model_id, subfolder="text_encoder")
+    elif args.text_encoder_class == "t5":
+        text_encoder = T5EncoderModel.from_pretrained(args.model_id, subfolder="text_encoder")
+    text_encoder.requires_grad_(False)
+    text_encoder.to(device)
+
+    with open(args.caption_path, "r") as f:
+        captions = f.readlines()
+
+    prompt_embeds_list = []
+    attention_mask_list = []
+    for start in tqdm(range(0, len(captions), args.batch_size)):
+        batch = captions[start : start + args.batch_size]
+        prompt_embeds, attention_mask = encode_prompt(batch, text_encoder, tokenizer)
+        prompt_embeds_list.append(prompt_embeds.cpu())
+        if attention_mask is not None:
+            attention_mask_list.append(attention_mask.cpu())
+
+    data = {"captions": captions, "prompt_embeds": torch.cat(prompt_embeds_list, dim=0)}
+    if attention_mask_list:
+        data["attention_masks"] = torch.cat(attention_mask_list, dim=0)
+    torch.save(data, args.save_path)
+    print(f"Saved {len(captions)} prompt embeds to {args.save_path}")
+
+
+if __name__ == "__main__":
+    main()
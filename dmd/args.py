@@ -123,6 +123,12 @@ def add_training_args(parser):
         help="Whether to cast the teacher U-Net to the precision specified by `--mixed_precision`.",
     )
     parser.add_argument("--enable_xformers_memory_efficient_attention", action="store_true", help="Whether or not to use xformers.")
+    parser.add_argument(
+        "--compile_model",
+        action="store_true",
+        help="Whether to wrap the teacher/fake/student models with `torch.compile(mode='reduce-overhead')`. "
+        "Keep the batch sizes constant across steps to avoid recompilation.",
+    )
     parser.add_argument(
         "--gradient_checkpointing",
         action="store_true",
@@ -243,6 +249,13 @@ def add_dataloader_args(parser):
     parser.add_argument("--reg_batch_size", type=int, default=16, help="Batch size (per device) for the training dataloader.")
     parser.add_argument("--reg_data_path", type=str)
     parser.add_argument("--dm_data_path", type=str)
+    parser.add_argument(
+        "--dm_embed_path",
+        type=str,
+        default=None,
+        help="Optional path to prompt embeddings precomputed with build_prompt_embeds.py. "
+        "When set, the DM dataloader yields embeddings and the per-step text-encoder forward is skipped.",
+    )
 
 
 def parse_args():
@@ -23,6 +23,25 @@ class TextDataset(torch.utils.data.Dataset):
         return len(self.captions)
 
 
+class TextEmbedDataset(torch.utils.data.Dataset):
+    """TextDataset with prompt embeddings precomputed by build_prompt_embeds.py."""
+
+    def __init__(self, path):
+        super().__init__()
+        data = torch.load(path, map_location="cpu")
+        self.captions = data["captions"]
+        self.prompt_embeds = data["prompt_embeds"]
+        self.attention_masks = data.get("attention_masks")
+
+    def __getitem__(self, index):
+        if self.attention_masks is None:
+            return self.captions[index], self.prompt_embeds[index]
+        return self.captions[index], self.prompt_embeds[index], self.attention_masks[index]
+
+    def __len__(self):
+        return len(self.captions)
+
+
 class RegressionDataset(torch.utils.data.Dataset):
     def __init__(self, data_root):
         super().__init__()
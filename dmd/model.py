@@ -1,12 +1,12 @@
 import torch
 import torch.nn.functional as F
-from diffusers.utils.torch_utils import randn_tensor
+import torch.utils.checkpoint
 from diffusers import Transformer2DModel
 from accelerate.utils.other import extract_model_from_parallel
 from transformers import T5EncoderModel
 
 
-def prepare_latents(model, vae, batch_size, device, dtype, generator=None):
+def latent_shape(model, vae):
     num_channels_latents = model.config.in_channels
     # autoencodertiny only has encoder_block_out_channels attribute.
     # [1,1,1,1] is dummy block_out_channels, it corresponds to default scale factor 4
@@ -14,8 +14,19 @@ def prepare_latents(model, vae, batch_size, device, dtype, generator=None):
     vae_scale_factor = 2 ** (len(block_out_channels) - 1)
     height = model.config.sample_size * vae_scale_factor
     width = model.config.sample_size * vae_scale_factor
-    shape = (batch_size, num_channels_latents, height // vae_scale_factor, width // vae_scale_factor)
-    latents = randn_tensor(shape, generator=generator, device=device, dtype=dtype)
+    return (num_channels_latents, height // vae_scale_factor, width // vae_scale_factor)
+
+
+def prepare_latents(model, vae, batch_size, device, dtype, generator=None, shape=None):
+    # the geometry is constant across steps; callers in the training loop pass a cached shape
+    if shape is None:
+        shape = latent_shape(model, vae)
+    latents = torch.empty((batch_size, *shape), device=device, dtype=dtype).to(memory_format=torch.channels_last)
+    if generator is not None and generator.device != latents.device:
+        # draw on the generator's device and copy over, matching the old randn_tensor behaviour
+        latents.copy_(torch.randn(latents.shape, generator=generator, dtype=dtype))
+    else:
+        latents.normal_(generator=generator)
     return latents
 
 
@@ -25,7 +36,7 @@ def encode_prompt(captions, text_encoder, tokenizer):
     is_pixart = isinstance(text_encoder, T5EncoderModel)
     if is_pixart:
         max_length = 120
-    with torch.no_grad():
+    with torch.inference_mode():
         text_inputs = tokenizer(captions, padding="max_length", max_length=max_length, truncation=True, return_tensors="pt")
         text_input_ids = text_inputs.input_ids
         prompt_embeds = text_encoder(text_input_ids.to(text_encoder.device))[0]
@@ -34,6 +45,12 @@ def encode_prompt(captions, text_encoder, tokenizer):
     if not is_pixart:
         attention_mask = None
 
+    # The embeds feed autograd-tracked forwards downstream (student training), which cannot save
+    # inference tensors for backward, so clone them out of inference mode at the boundary.
+    prompt_embeds = prompt_embeds.clone()
+    if attention_mask is not None:
+        attention_mask = attention_mask.clone()
+
     return prompt_embeds, attention_mask
 
 
@@ -117,27 +134,45 @@ def generate_ms(model, scheduler, latents, prompt_embeds, prompt_attention_masks
     return outputs
 
 
-def generate(model, scheduler, latents, prompt_embeds, prompt_attention_masks=None):
+def generate(model, scheduler, latents, prompt_embeds, prompt_attention_masks=None, gradient_checkpointing=False):
     t = torch.full((1,), scheduler.config.num_train_timesteps - 1, device=latents.device).long()
-    noise_pred = forward_model(
-        model,
-        latents=latents,
-        timestep=t,
-        prompt_embeds=prompt_embeds,
-        prompt_attention_masks=prompt_attention_masks,
-    )
+    if gradient_checkpointing and torch.is_grad_enabled():
+        # Checkpoint the whole generator forward so its activations are recomputed in backward
+        # instead of stored; this is coarser than the per-block checkpointing inside the model.
+        noise_pred = torch.utils.checkpoint.checkpoint(
+            lambda l, ts, e, m: forward_model(model, latents=l, timestep=ts, prompt_embeds=e, prompt_attention_masks=m),
+            latents,
+            t,
+            prompt_embeds,
+            prompt_attention_masks,
+            use_reentrant=False,
+        )
+    else:
+        noise_pred = forward_model(
+            model,
+            latents=latents,
+            timestep=t,
+            prompt_embeds=prompt_embeds,
+            prompt_attention_masks=prompt_attention_masks,
+        )
     latents = eps_to_mu(scheduler, noise_pred, latents, t)
     return latents
 
 
+@torch.compile(fullgraph=True, dynamic=False)
+def _eps_to_mu(alpha_prod_t, model_output, sample):
+    return (sample - (1 - alpha_prod_t).sqrt() * model_output) / alpha_prod_t.sqrt()
+
+
 def eps_to_mu(scheduler, model_output, sample, timesteps):
-    alphas_cumprod = scheduler.alphas_cumprod.to(device=sample.device, dtype=sample.dtype)
-    alpha_prod_t = alphas_cumprod[timesteps]
-    while len(alpha_prod_t.shape) < len(sample.shape):
-        alpha_prod_t = alpha_prod_t.unsqueeze(-1)
-    beta_prod_t = 1 - alpha_prod_t
-    pred_original_sample = (sample - beta_prod_t ** (0.5) * model_output) / alpha_prod_t ** (0.5)
-    return pred_original_sample
+    alphas_cumprod = scheduler.alphas_cumprod
+    if alphas_cumprod.device != sample.device:
+        # one-time move for callers that did not pre-place the schedule (see setup_model)
+        alphas_cumprod = alphas_cumprod.to(device=sample.device)
+        scheduler.alphas_cumprod = alphas_cumprod
+    # latents are 4D, so broadcast the gathered alphas without the unsqueeze loop
+    alpha_prod_t = alphas_cumprod[timesteps].to(dtype=sample.dtype).view(-1, 1, 1, 1)
+    return _eps_to_mu(alpha_prod_t, model_output, sample)
 
 
 def distribution_matching_loss(
@@ -151,47 +186,94 @@ def distribution_matching_loss(
     negative_prompt_attention_masks,
     args,
 ):
-    bsz = latents.shape[0]
     min_dm_step = int(noise_scheduler.config.num_train_timesteps * args.min_dm_step_ratio)
     max_dm_step = int(noise_scheduler.config.num_train_timesteps * args.max_dm_step_ratio)
 
-    timestep = torch.randint(min_dm_step, max_dm_step, (bsz,), device=latents.device).long()
-    noise = torch.randn_like(latents)
+    noise, timestep = sample_noise_timesteps(latents, min_dm_step, max_dm_step)
     noisy_latents = noise_scheduler.add_noise(latents, noise, timestep)
+    noisy_latents = noisy_latents.contiguous(memory_format=torch.channels_last)
+
+    with torch.inference_mode():
+        # The fake model is prepared by accelerate, so autocast handles its input dtypes; only the
+        # raw teacher needs the embeds in its own dtype, cast once instead of .float() per call.
+        real_dtype = extract_model_from_parallel(real_model).dtype
 
-    with torch.no_grad():
         noise_pred = forward_model(
             fake_model,
             latents=noisy_latents,
             timestep=timestep,
-            prompt_embeds=prompt_embeds.float(),
+            prompt_embeds=prompt_embeds,
             prompt_attention_masks=prompt_attention_masks,
         )
         pred_fake_latents = eps_to_mu(noise_scheduler, noise_pred, noisy_latents, timestep)
 
-        noisy_latents_input = torch.cat([noisy_latents] * 2)
-        timestep_input = torch.cat([timestep] * 2)
-        prompt_embeds = torch.cat([negative_prompt_embeds, prompt_embeds], dim=0)
-        if prompt_attention_masks is not None:
-            prompt_attention_masks = torch.cat([negative_prompt_attention_masks, prompt_attention_masks], dim=0)
-        noise_pred = forward_model(
-            real_model,
-            latents=noisy_latents_input,
-            timestep=timestep_input,
-            prompt_embeds=prompt_embeds.float(),
-            prompt_attention_masks=prompt_attention_masks,
-        )
-        noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-        noise_pred = noise_pred_uncond + args.guidance_scale * (noise_pred_text - noise_pred_uncond)
+        if args.guidance_scale == 1.0:
+            # CFG is a no-op at scale 1; skip the unconditional half of the teacher forward.
+            noise_pred = forward_model(
+                real_model,
+                latents=noisy_latents,
+                timestep=timestep,
+                prompt_embeds=prompt_embeds.to(dtype=real_dtype),
+                prompt_attention_masks=prompt_attention_masks,
+            )
+        else:
+            noisy_latents_input = torch.cat([noisy_latents] * 2).contiguous(memory_format=torch.channels_last)
+            timestep_input = torch.cat([timestep] * 2)
+            prompt_embeds = torch.cat([negative_prompt_embeds, prompt_embeds], dim=0).to(dtype=real_dtype)
+            if prompt_attention_masks is not None:
+                prompt_attention_masks = torch.cat([negative_prompt_attention_masks, prompt_attention_masks], dim=0)
+            noise_pred = forward_model(
+                real_model,
+                latents=noisy_latents_input,
+                timestep=timestep_input,
+                prompt_embeds=prompt_embeds,
+                prompt_attention_masks=prompt_attention_masks,
+            )
+            noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+            # lerp(a, b, w) == a + w * (b - a): one fused kernel for the CFG combine
+            noise_pred = torch.lerp(noise_pred_uncond, noise_pred_text, args.guidance_scale)
 
         pred_real_latents = eps_to_mu(noise_scheduler, noise_pred, noisy_latents, timestep)
 
-    weighting_factor = torch.abs(latents - pred_real_latents).mean(dim=[1, 2, 3], keepdim=True)
+        # the weighting is only ever used detached, so take the abs in place instead of allocating a copy
+        diff = latents - pred_real_latents
+        weighting_factor = diff.abs_().mean(dim=(1, 2, 3), keepdim=True)
+
+        # pred_fake_latents is not used again, so compute the gradient direction in place
+        grad = pred_fake_latents.sub_(pred_real_latents).div_(weighting_factor)
 
-    grad = (pred_fake_latents - pred_real_latents) / weighting_factor
-    loss = F.mse_loss(latents, stopgrad(latents - grad))
+    # build the target from detached latents so the inference-mode grad tensor never enters
+    # the autograd graph; equivalent to stopgrad(latents - grad)
+    loss = F.mse_loss(latents, stopgrad(latents) - grad)
     return loss
 
 
 def stopgrad(x):
     return x.detach()
+
+
+_rng_stream = None
+
+
+def sample_noise_timesteps(latents, min_step, max_step):
+    """Sample per-batch noise and timesteps on a side CUDA stream.
+
+    The default stream usually still has the previous model forward queued, so issuing the RNG
+    kernels on their own stream lets them run concurrently instead of waiting in line.
+    """
+    global _rng_stream
+    if latents.device.type != "cuda":
+        timesteps = torch.randint(min_step, max_step, (latents.shape[0],), device=latents.device).long()
+        noise = torch.randn_like(latents)
+        return noise, timesteps
+
+    if _rng_stream is None:
+        _rng_stream = torch.cuda.Stream()
+    with torch.cuda.stream(_rng_stream):
+        timesteps = torch.randint(min_step, max_step, (latents.shape[0],), device=latents.device).long()
+        noise = torch.randn_like(latents)
+    current_stream = torch.cuda.current_stream()
+    current_stream.wait_stream(_rng_stream)
+    noise.record_stream(current_stream)
+    timesteps.record_stream(current_stream)
+    return noise, timesteps
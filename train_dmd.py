@@ -15,16 +15,26 @@ import torch.utils.data
 import transformers
 from accelerate import Accelerator
 from accelerate.logging import get_logger
-from accelerate.utils import ProjectConfiguration, set_seed
+from accelerate.utils import DistributedDataParallelKwargs, ProjectConfiguration, set_seed
 from diffusers import DDPMScheduler, UNet2DConditionModel, AutoencoderTiny, AutoencoderKL, Transformer2DModel
+from diffusers.models.attention_processor import AttnProcessor2_0
 from diffusers.optimization import get_scheduler
 from diffusers.training_utils import compute_snr
 from packaging import version
 from transformers import AutoTokenizer, CLIPTextModel, BertModel, T5EncoderModel
 from PIL import Image
 from dmd.args import parse_args
-from dmd.data import cycle, TextDataset, RegressionDataset
-from dmd.model import distribution_matching_loss, encode_prompt, generate, prepare_latents, stopgrad, forward_model
+from dmd.data import cycle, TextDataset, TextEmbedDataset, RegressionDataset
+from dmd.model import (
+    distribution_matching_loss,
+    encode_prompt,
+    generate,
+    latent_shape,
+    prepare_latents,
+    sample_noise_timesteps,
+    stopgrad,
+    forward_model,
+)
 
 logger = get_logger(__name__)
 
@@ -64,11 +74,16 @@ def setup_training(args):
 
     accelerator_project_config = ProjectConfiguration(project_dir=args.output_dir, logging_dir=logging_dir)
 
+    # The fake/student graphs are identical every step and the models have no buffers that need
+    # syncing, so let DDP fuse allreduce buckets aggressively and skip the per-step buffer broadcast.
+    ddp_kwargs = DistributedDataParallelKwargs(broadcast_buffers=False, gradient_as_bucket_view=True, static_graph=True)
+
     accelerator = Accelerator(
         gradient_accumulation_steps=args.gradient_accumulation_steps,
         mixed_precision=args.mixed_precision,
         log_with=args.report_to,
         project_config=accelerator_project_config,
+        kwargs_handlers=[ddp_kwargs],
         # split_batches=True,  # It's important to set this to True when using webdataset to get the right number of steps for lr scheduling. If set to False, the number of steps will be devide by the number of processes assuming batches are multiplied by the number of processes
     )
 
@@ -119,6 +134,8 @@ def setup_model_class(model_cls):
 
 def setup_model(args, accelerator, weight_dtype):
     noise_scheduler = DDPMScheduler.from_pretrained(args.pretrained_teacher_model, subfolder="scheduler")
+    # Keep the schedule on device (fp32 for add_noise precision) so eps_to_mu never pays a H2D copy.
+    noise_scheduler.alphas_cumprod = noise_scheduler.alphas_cumprod.to(accelerator.device)
     tokenizer = AutoTokenizer.from_pretrained(args.pretrained_teacher_model, subfolder="tokenizer", legacy=False, use_fast=False)
 
     if args.text_encoder_class == "clip":
@@ -139,13 +156,16 @@ def setup_model(args, accelerator, weight_dtype):
     text_encoder.requires_grad_(False)
     real_model.requires_grad_(False)
 
-    fake_model = MODEL_CLS(**real_model.config)
-    fake_model.load_state_dict(real_model.state_dict(), strict=False)
-    fake_model.train()
-
-    student_model = MODEL_CLS(**real_model.config)
-    student_model.load_state_dict(real_model.state_dict(), strict=False)
-    student_model.train()
+    # Build the trainable copies on the meta device and materialize them with cloned teacher
+    # weights, skipping the zero/random init pass and its extra full-model allocation each.
+    with accelerate.init_empty_weights():
+        fake_model = MODEL_CLS(**real_model.config)
+    with accelerate.init_empty_weights():
+        student_model = MODEL_CLS(**real_model.config)
+    for model in (fake_model, student_model):
+        model.load_state_dict({k: v.detach().clone() for k, v in real_model.state_dict().items()}, strict=False, assign=True)
+        model.requires_grad_(True)
+        model.train()
 
     # Move model, vae and text_encoder to device and cast to weight_dtype
     # The VAE is in float32 to avoid NaN losses.
@@ -159,10 +179,28 @@ def setup_model(args, accelerator, weight_dtype):
     if args.cast_teacher_model:
         real_model.to(dtype=weight_dtype)
 
+    # Fused attention (SDPA -> Flash / mem-efficient kernels) for every training forward,
+    # not just validation; optionally xformers instead.
+    for model in (real_model, fake_model, student_model):
+        if args.enable_xformers_memory_efficient_attention:
+            model.enable_xformers_memory_efficient_attention()
+        else:
+            model.set_attn_processor(AttnProcessor2_0())
+
     if args.gradient_checkpointing:
         student_model.enable_gradient_checkpointing()
         fake_model.enable_gradient_checkpointing()
 
+    if args.compile_model:
+        # channels_last lets cuDNN/Inductor pick NHWC conv kernels; only meaningful for the conv-heavy U-Net.
+        if MODEL_CLS is UNet2DConditionModel:
+            for model in (real_model, fake_model, student_model):
+                model.to(memory_format=torch.channels_last)
+        # fullgraph=False so Dynamo can fall back through gradient-checkpointed regions.
+        real_model = torch.compile(real_model, mode="reduce-overhead", fullgraph=False)
+        fake_model = torch.compile(fake_model, mode="reduce-overhead", fullgraph=False)
+        student_model = torch.compile(student_model, mode="reduce-overhead", fullgraph=False)
+
     return real_model, fake_model, student_model, noise_scheduler, tokenizer, text_encoder, vae
 
 
@@ -186,21 +224,19 @@ def setup_model_saving(accelerator, student_model):
 
 
 def setup_optimizer_scheduler(args, fake_model, student_model):
-    fake_optimizer = torch.optim.AdamW(
-        fake_model.parameters(),
+    # fused=True runs the AdamW update as one kernel per parameter group; foreach is the CPU fallback.
+    adamw_kwargs = dict(
         lr=args.learning_rate,
         betas=(args.adam_beta1, args.adam_beta2),
         weight_decay=args.adam_weight_decay,
         eps=args.adam_epsilon,
+        fused=torch.cuda.is_available(),
+        foreach=None if torch.cuda.is_available() else True,
     )
 
-    student_optimizer = torch.optim.AdamW(
-        student_model.parameters(),
-        lr=args.learning_rate,
-        betas=(args.adam_beta1, args.adam_beta2),
-        weight_decay=args.adam_weight_decay,
-        eps=args.adam_epsilon,
-    )
+    fake_optimizer = torch.optim.AdamW(fake_model.parameters(), **adamw_kwargs)
+
+    student_optimizer = torch.optim.AdamW(student_model.parameters(), **adamw_kwargs)
 
     fake_lr_scheduler = get_scheduler(
         args.lr_scheduler,
@@ -218,14 +254,19 @@ def setup_optimizer_scheduler(args, fake_model, student_model):
 
 
 def setup_dataloader(args):
-    dataset = TextDataset(args.dm_data_path)
-    dm_dataloader = torch.utils.data.DataLoader(
-        dataset, batch_size=args.dm_batch_size, num_workers=args.dataloader_num_workers, pin_memory=True, shuffle=True
-    )
+    # Keep workers alive across the epoch boundaries cycle() crosses and prefetch a few batches
+    # ahead so the GPU never waits on the loaders; both options require num_workers > 0.
+    loader_kwargs = dict(num_workers=args.dataloader_num_workers, pin_memory=True, shuffle=True)
+    if args.dataloader_num_workers > 0:
+        loader_kwargs.update(persistent_workers=True, prefetch_factor=4)
+
+    if args.dm_embed_path is not None:
+        dataset = TextEmbedDataset(args.dm_embed_path)
+    else:
+        dataset = TextDataset(args.dm_data_path)
+    dm_dataloader = torch.utils.data.DataLoader(dataset, batch_size=args.dm_batch_size, **loader_kwargs)
     dataset = RegressionDataset(args.reg_data_path)
-    reg_dataloader = torch.utils.data.DataLoader(
-        dataset, batch_size=args.reg_batch_size, num_workers=args.dataloader_num_workers, pin_memory=True, shuffle=True
-    )
+    reg_dataloader = torch.utils.data.DataLoader(dataset, batch_size=args.reg_batch_size, **loader_kwargs)
     dm_dataloader = cycle(dm_dataloader)
     reg_dataloader = cycle(reg_dataloader)
     return dm_dataloader, reg_dataloader
@@ -301,6 +342,12 @@ def main(args):
             accelerator.load_state(os.path.join(args.output_dir, path))
             global_step = int(path.split("-")[1])
 
+    # The unconditional ("") embedding is constant; encode it once and expand per batch inside the loop.
+    negative_prompt_embed, negative_prompt_attention_mask = encode_prompt([""], text_encoder, tokenizer)
+
+    # The latent geometry is constant across steps; compute it once for prepare_latents.
+    dm_latent_shape = latent_shape(accelerator.unwrap_model(student_model), vae)
+
     lpips = piq.LPIPS()
     tracker = MetricTracker(50)
     if accelerator.is_main_process:
@@ -309,10 +356,18 @@ def main(args):
     for step in range(args.max_train_steps):
         start_time = time.time()
 
-        prompts = next(dm_dataloader)
+        dm_prompt_embeds = dm_prompt_attention_masks = None
+        if args.dm_embed_path is not None:
+            dm_batch = next(dm_dataloader)
+            prompts = list(dm_batch[0])
+            dm_prompt_embeds = dm_batch[1].to(accelerator.device, dtype=weight_dtype, non_blocking=True)
+            if len(dm_batch) > 2:
+                dm_prompt_attention_masks = dm_batch[2].to(accelerator.device, non_blocking=True)
+        else:
+            prompts = next(dm_dataloader)
         latents_ref, images_ref, prompts_ref = next(reg_dataloader)
-        latents_ref = latents_ref.to(accelerator.device)
-        images_ref = images_ref.to(accelerator.device)
+        latents_ref = latents_ref.to(accelerator.device, non_blocking=True).contiguous(memory_format=torch.channels_last)
+        images_ref = images_ref.to(accelerator.device, non_blocking=True)
 
         if args.gradient_checkpointing:
             accelerator.unwrap_model(fake_model).disable_gradient_checkpointing()
@@ -326,28 +381,64 @@ def main(args):
 
         if args.reg_loss_weight > 0:
             prompt_ref_embeds, prompt_ref_attention_masks = encode_prompt(prompts_ref, text_encoder, tokenizer)
-            latents_ref_pred = generate(student_model, noise_scheduler, latents_ref, prompt_ref_embeds, prompt_ref_attention_masks)
-            images_ref_pred = vae.decode(latents_ref_pred.to(vae.dtype) / vae.config.scaling_factor).sample
-            images_ref_pred = (images_ref_pred / 2 + 0.5).clamp(0, 1)
-            images_ref_pred = images_ref_pred.to(dtype=images_ref.dtype)
-            loss_reg = lpips(images_ref, images_ref_pred)
-            loss_g += loss_reg * args.reg_loss_weight
 
         if args.kl_loss_weight > 0:
-            prompt_embeds, prompt_attention_masks = encode_prompt(prompts, text_encoder, tokenizer)
+            if dm_prompt_embeds is not None:
+                prompt_embeds, prompt_attention_masks = dm_prompt_embeds, dm_prompt_attention_masks
+            else:
+                prompt_embeds, prompt_attention_masks = encode_prompt(prompts, text_encoder, tokenizer)
             latents = prepare_latents(
-                accelerator.unwrap_model(student_model), vae, batch_size=len(prompts), device=accelerator.device, dtype=weight_dtype
+                accelerator.unwrap_model(student_model),
+                vae,
+                batch_size=len(prompts),
+                device=accelerator.device,
+                dtype=weight_dtype,
+                shape=dm_latent_shape,
+            )
+
+        if args.reg_loss_weight > 0 and args.kl_loss_weight > 0:
+            # One batched student forward over [dm | reg]; the ordering matches the concat the
+            # distribution-matching loss used to build itself, so the result is reused as-is below.
+            latents_all = torch.cat([latents, latents_ref], dim=0).contiguous(memory_format=torch.channels_last)
+            prompt_embeds_all = torch.cat([prompt_embeds, prompt_ref_embeds], dim=0)
+            prompt_attention_masks_all = None
+            if prompt_attention_masks is not None:
+                prompt_attention_masks_all = torch.cat([prompt_attention_masks, prompt_ref_attention_masks], dim=0)
+            latents_pred_all = generate(
+                student_model, noise_scheduler, latents_all, prompt_embeds_all, prompt_attention_masks_all, gradient_checkpointing=args.gradient_checkpointing
+            )
+            latents_pred, latents_ref_pred = latents_pred_all.split([len(prompts), len(prompts_ref)], dim=0)
+        elif args.reg_loss_weight > 0:
+            latents_ref_pred = generate(
+                student_model, noise_scheduler, latents_ref, prompt_ref_embeds, prompt_ref_attention_masks, gradient_checkpointing=args.gradient_checkpointing
+            )
+        elif args.kl_loss_weight > 0:
+            latents_pred = generate(
+                student_model, noise_scheduler, latents, prompt_embeds, prompt_attention_masks, gradient_checkpointing=args.gradient_checkpointing
             )
-            latents_pred = generate(student_model, noise_scheduler, latents, prompt_embeds, prompt_attention_masks)
 
+        if args.reg_loss_weight > 0:
+            # The VAE stays fp32 but the decode + LPIPS convs run in weight_dtype under autocast;
+            # loss_reg only needs gradients w.r.t. latents_ref_pred, so reduced precision is safe here.
+            autocast_enabled = weight_dtype != torch.float32 and accelerator.device.type == "cuda"
+            with torch.autocast(accelerator.device.type, dtype=weight_dtype, enabled=autocast_enabled):
+                images_ref_pred = vae.decode(latents_ref_pred.to(vae.dtype) / vae.config.scaling_factor).sample
+                images_ref_pred = (images_ref_pred / 2 + 0.5).clamp(0, 1)
+                images_ref_pred = images_ref_pred.to(dtype=images_ref.dtype)
+                loss_reg = lpips(images_ref, images_ref_pred)
+            loss_g += loss_reg * args.reg_loss_weight
+
+        if args.kl_loss_weight > 0:
             if args.reg_loss_weight > 0:
-                latents_pred = torch.cat([latents_pred, latents_ref_pred], dim=0)
+                latents_pred = latents_pred_all
                 prompts = prompts + prompts_ref
-                prompt_embeds = torch.cat([prompt_embeds, prompt_ref_embeds], dim=0)
-                if prompt_attention_masks is not None:
-                    prompt_attention_masks = torch.cat([prompt_attention_masks, prompt_ref_attention_masks], dim=0)
+                prompt_embeds = prompt_embeds_all
+                prompt_attention_masks = prompt_attention_masks_all
 
-            negative_prompt_embeds, negative_prompt_attention_masks = encode_prompt([""] * len(prompts), text_encoder, tokenizer)
+            negative_prompt_embeds = negative_prompt_embed.expand(len(prompts), -1, -1)
+            negative_prompt_attention_masks = None
+            if negative_prompt_attention_mask is not None:
+                negative_prompt_attention_masks = negative_prompt_attention_mask.expand(len(prompts), -1)
             loss_kl = distribution_matching_loss(
                 real_model,
                 fake_model,
@@ -389,14 +480,11 @@ def main(args):
                 if prompt_ref_attention_masks is not None:
                     prompt_attention_masks = stopgrad(prompt_ref_attention_masks)
 
-            # Sample noise that we'll add to the latents
-            noise = torch.randn_like(latents)
-            bsz = latents.shape[0]
-            # Sample a random timestep for each image
-            timesteps = torch.randint(0, noise_scheduler.config.num_train_timesteps, (bsz,), device=latents.device)
-            timesteps = timesteps.long()
+            # Sample noise we'll add to the latents and a random timestep for each image,
+            # issued on a side stream so the RNG overlaps with the queued student backward.
+            noise, timesteps = sample_noise_timesteps(latents, 0, noise_scheduler.config.num_train_timesteps)
 
-            noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps)
+            noisy_latents = noise_scheduler.add_noise(latents, noise, timesteps).contiguous(memory_format=torch.channels_last)
 
             if noise_scheduler.config.prediction_type == "epsilon":
                 target = noise
@@ -414,8 +502,11 @@ def main(args):
                 prompt_attention_masks=prompt_attention_masks,
             )
 
+            # Square in the native dtype and accumulate the reduction in fp32 rather than
+            # materializing fp32 copies of both latent-shaped tensors first.
+            diff = model_pred - target
             if args.snr_gamma is None:
-                loss_d = F.mse_loss(model_pred.float(), target.float(), reduction="mean")
+                loss_d = diff.pow(2).mean(dtype=torch.float32)
             else:
                 # Compute loss-weights as per Section 3.4 of https://arxiv.org/abs/2303.09556.
                 # Since we predict the noise instead of x_0, the original formulation is slightly changed.
@@ -426,8 +517,7 @@ def main(args):
                     snr = snr + 1
                 mse_loss_weights = torch.stack([snr, args.snr_gamma * torch.ones_like(timesteps)], dim=1).min(dim=1)[0] / snr
 
-                loss = F.mse_loss(model_pred.float(), target.float(), reduction="none")
-                loss = loss.mean(dim=list(range(1, len(loss.shape)))) * mse_loss_weights
+                loss = diff.pow(2).mean(dim=list(range(1, diff.dim())), dtype=torch.float32) * mse_loss_weights
                 loss_d = loss.mean()
 
             accelerator.backward(loss_d)
@@ -435,7 +525,7 @@ def main(args):
                 accelerator.clip_grad_norm_(fake_model.parameters(), args.max_grad_norm)
             fake_optimizer.step()
             fake_lr_scheduler.step()
-            fake_optimizer.zero_grad()
+            fake_optimizer.zero_grad(set_to_none=True)
 
             logs.update({"loss_d": loss_d.detach().item()})
             tracker.update({"loss_d": loss_d.detach().item()})